@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import sys
@@ -5,7 +6,8 @@ from functools import lru_cache
 from io import BytesIO, StringIO
 from logging import Logger
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from urllib.parse import quote
 
 import numpy as np
 import pandas as pd
@@ -27,7 +29,18 @@ from azure.storage.blob import (
 )
 
 from azure_wrappers import version_info
-from azure_wrappers.data_parsing import parse_data_source
+from azure_wrappers.data_parsing import (
+    EXCEL_SIDECAR_MANIFEST,
+    excel_sheet_to_parquet,
+    excel_sidecar_folder,
+    excel_sidecar_prefix,
+    extract_pdf_text_batch,
+    parse_data_source,
+    pdf_text_from_frame,
+    pdf_text_sidecar_name,
+    pdf_text_to_frame,
+    select_excel_columns,
+)
 
 LOGGER = Logger(__file__)
 DEFAULT_TENANT_ID = "YOUR_TENANT_ID"
@@ -128,10 +141,21 @@ def get_az_data(
     file_name,
     return_stream=False,
     version_id=None,
+    sheet_name=None,
+    usecols=None,
+    nrows=None,
+    cache_excel=False,
 ):
     """
     Download a file from Azure blob storage
     Uses container client directly
+
+    For excel files sheet_name, usecols and nrows work as in pd.read_excel.
+    With the default sheet_name=None every sheet is returned as a dictionary.
+    If cache_excel is True each sheet is converted once to a parquet file
+    stored next to the workbook (keyed by its ETag) and later calls read the
+    parquet copies instead of parsing the workbook. Copies of older versions
+    of the workbook are deleted once a new version is converted.
     """
     try:
         tenant_id = os.environ.get("TENANT_ID", DEFAULT_TENANT_ID)
@@ -144,21 +168,326 @@ def get_az_data(
             "Could not connect to azure for the container: {container_name}"
         )
 
-    stream = container_client.get_blob_client(file_name).download_blob(version_id=version_id)
-    if return_stream and ".pdf" in file_name:
-        data = stream.readall()
-        return data
-    data = parse_data_source(
-                file_name,
-                stream,
-                return_stream,
-    )
+    if cache_excel and ".xls" in file_name and not return_stream:
+        data = _get_cached_excel(
+            container_client,
+            file_name,
+            version_id=version_id,
+            sheet_name=sheet_name,
+            usecols=usecols,
+            nrows=nrows,
+        )
+    else:
+        stream = container_client.get_blob_client(file_name).download_blob(
+            version_id=version_id
+        )
+        if return_stream and ".pdf" in file_name:
+            data = stream.readall()
+            return data
+        data = parse_data_source(
+                    file_name,
+                    stream,
+                    return_stream,
+                    sheet_name=sheet_name,
+                    usecols=usecols,
+                    nrows=nrows,
+        )
     # drop Unnamed: 0 columns from dataframe before returning it
     if isinstance(data, pd.DataFrame):
         data.drop(data.filter(regex="Unnamed"), axis=1, inplace=True)
     return data
 
 
+def _get_cached_excel(
+    container_client,
+    file_name,
+    version_id=None,
+    sheet_name=None,
+    usecols=None,
+    nrows=None,
+):
+    """
+    Read an excel blob from its parquet copies, converting every sheet of the
+    workbook the first time it is read.
+
+    A manifest listing the sheets in workbook order, their parquet blobs and
+    original column names is uploaded after every sheet, so a failed or
+    in-progress conversion is never read as complete. If a sheet listed in
+    the manifest has gone missing the workbook is converted again. Sheets
+    that would not come back from parquet unchanged (see
+    excel_sheet_to_parquet) are listed without a blob and read from the
+    workbook instead. Once the current version is converted the copies of
+    older versions are deleted; reading an older version with version_id
+    never deletes anything.
+
+    Column types are inferred from the whole sheet before nrows is applied,
+    so with nrows they can differ from pd.read_excel(nrows=...).
+    """
+    blob_client = container_client.get_blob_client(file_name)
+    etag = blob_client.get_blob_properties(version_id=version_id).etag
+    prefix = excel_sidecar_prefix(file_name, etag)
+    try:
+        manifest = json.loads(
+            container_client.get_blob_client(prefix + EXCEL_SIDECAR_MANIFEST)
+            .download_blob()
+            .readall()
+        )
+    except ResourceNotFoundError:
+        manifest = None
+    if manifest is not None:
+        try:
+            return _read_excel_sheets(
+                container_client,
+                blob_client,
+                manifest,
+                version_id=version_id,
+                sheet_name=sheet_name,
+                usecols=usecols,
+                nrows=nrows,
+            )
+        except ResourceNotFoundError:
+            LOGGER.warning(
+                f"Parquet copies of {file_name} are incomplete, converting it again."
+            )
+
+    parsed = parse_data_source(
+        file_name, blob_client.download_blob(version_id=version_id)
+    )
+    manifest = _convert_excel_to_parquet(container_client, file_name, prefix, parsed)
+    if version_id is None:
+        _delete_old_excel_copies(container_client, file_name, prefix)
+    return _read_excel_sheets(
+        container_client,
+        blob_client,
+        manifest,
+        parsed=parsed,
+        version_id=version_id,
+        sheet_name=sheet_name,
+        usecols=usecols,
+        nrows=nrows,
+    )
+
+
+def _read_excel_sheets(
+    container_client,
+    blob_client,
+    manifest,
+    parsed=None,
+    version_id=None,
+    sheet_name=None,
+    usecols=None,
+    nrows=None,
+):
+    # reads from the already parsed workbook when it is given, otherwise
+    # from the parquet copies listed in the manifest
+    sheets = manifest["sheets"]
+    sheets_by_name = {sheet["name"]: sheet for sheet in sheets}
+    if sheet_name is None:
+        wanted = [sheet["name"] for sheet in sheets]
+    elif isinstance(sheet_name, (list, tuple)):
+        wanted = sheet_name
+    else:
+        wanted = [sheet_name]
+
+    data = {}
+    workbook = None
+    for key in wanted:
+        if isinstance(key, int):
+            if not 0 <= key < len(sheets):
+                raise ValueError(
+                    f"Worksheet index {key} is invalid, {len(sheets)} worksheets found"
+                )
+            sheet = sheets[key]
+        elif key in sheets_by_name:
+            sheet = sheets_by_name[key]
+        else:
+            raise ValueError(f"Worksheet named '{key}' not found")
+
+        if parsed is not None:
+            frame = parsed[sheet["name"]]
+        elif sheet["blob"] is None:
+            if workbook is None:
+                workbook = blob_client.download_blob(version_id=version_id).readall()
+            frame = pd.read_excel(
+                BytesIO(workbook), sheet_name=sheet["name"], engine="openpyxl"
+            )
+        else:
+            columns = sheet["columns"]
+            # push column names down to the parquet reader, keeping workbook
+            # order; letter ranges, positions and callables are applied after
+            if isinstance(usecols, (list, tuple)) and all(
+                isinstance(col, str) for col in usecols
+            ):
+                columns = [col for col in columns if col in usecols]
+            frame = pd.read_parquet(
+                BytesIO(
+                    container_client.get_blob_client(sheet["blob"])
+                    .download_blob()
+                    .readall()
+                ),
+                columns=[str(col) for col in columns],
+                engine="pyarrow",
+            ).set_axis(columns, axis=1)
+        data[key] = select_excel_columns(frame, usecols, nrows)
+
+    if sheet_name is None or isinstance(sheet_name, (list, tuple)):
+        return data
+    return data[sheet_name]
+
+
+def _convert_excel_to_parquet(container_client, file_name, prefix, parsed):
+    sheets = []
+    for i, (name, frame) in enumerate(parsed.items()):
+        converted = excel_sheet_to_parquet(frame)
+        if converted is None:
+            LOGGER.warning(
+                f"Sheet {name} of {file_name} does not convert to parquet exactly "
+                "and will be read from the workbook."
+            )
+            sheets.append({"name": name, "blob": None, "columns": None})
+            continue
+        parquet_bytes, columns = converted
+        sheet_blob = f"{prefix}sheet_{i}.parquet"
+        container_client.upload_blob(
+            name=sheet_blob, data=parquet_bytes, overwrite=True, timeout=14400
+        )
+        sheets.append({"name": name, "blob": sheet_blob, "columns": columns})
+
+    manifest = {"sheets": sheets}
+    container_client.upload_blob(
+        name=prefix + EXCEL_SIDECAR_MANIFEST,
+        data=json.dumps(manifest),
+        overwrite=True,
+    )
+    LOGGER.info(f"Cached {len(sheets)} sheets of {file_name} under {prefix}")
+    return manifest
+
+
+def _delete_old_excel_copies(container_client, file_name, prefix):
+    # only blobs listed in an older manifest are deleted, anything else that
+    # happens to be in the folder is left alone
+    folder = excel_sidecar_folder(file_name)
+    for blob in container_client.list_blobs(name_starts_with=folder):
+        old_prefix = blob.name[: -len(EXCEL_SIDECAR_MANIFEST)]
+        if (
+            not blob.name.endswith("/" + EXCEL_SIDECAR_MANIFEST)
+            or old_prefix == prefix
+            or "/" in old_prefix[len(folder) : -1]
+        ):
+            continue
+        try:
+            manifest_client = container_client.get_blob_client(blob.name)
+            old_manifest = json.loads(manifest_client.download_blob().readall())
+            # remove the manifest first so nobody starts reading these copies
+            manifest_client.delete_blob()
+        except ResourceNotFoundError:
+            # another reader already deleted this version
+            continue
+        for sheet in old_manifest["sheets"]:
+            if sheet["blob"] is None:
+                continue
+            try:
+                container_client.delete_blob(sheet["blob"])
+            except ResourceNotFoundError:
+                pass
+
+
+def get_az_pdf_text(
+    account_url,
+    container_name,
+    file_names=None,
+    name_starts_with=None,
+    pages=None,
+    max_workers=None,
+    pages_per_chunk=8,
+    cache_text=False,
+    max_download_workers=8,
+):
+    """
+    Extract the text of a batch of pdfs in Azure blob storage. Either pass a
+    list of blob names or a folder prefix (name_starts_with) to process every
+    pdf under it. Returns a dictionary of {file_name: {page_number: text}}
+    where page numbers are zero-indexed. Pages past the end of a shorter pdf
+    are skipped, and pdfs that cannot be read are logged and left out.
+
+    Blobs are downloaded max_download_workers at a time while their pages are
+    extracted in a shared process pool (see extract_pdf_text_batch). Each
+    download is deleted from the temporary directory once its text has been
+    extracted. If cache_text is True the extracted pages of each pdf are
+    uploaded as a parquet file next to the blob, tagged with the ETag of the
+    pdf they came from. Later calls read cached pages from there and only
+    extract and add the pages that are not cached yet, as long as the pdf has
+    not changed.
+    """
+    tenant_id = os.environ.get("TENANT_ID", DEFAULT_TENANT_ID)
+    container_client = ContainerClient(
+        account_url, container_name, credential=get_credential(tenant_id)
+    )
+    if file_names is None:
+        file_names = [
+            blob.name
+            for blob in container_client.list_blobs(name_starts_with=name_starts_with)
+            if blob.name.lower().endswith(".pdf")
+        ]
+    # ETag of the version that was actually downloaded, used to tag the cache
+    etags = {}
+    # ETag the cached pages belong to, so they are not merged with the text
+    # of a newer upload
+    cached_etags = {}
+
+    def fetch_pdf(file_name):
+        pdf_path = os.path.join(tmp_dir, quote(file_name, safe=""))
+        stream = container_client.get_blob_client(file_name).download_blob()
+        etags[file_name] = stream.properties.etag.strip('"')
+        if cached_etags.get(file_name, etags[file_name]) != etags[file_name]:
+            raise ValueError(f"{file_name} changed while it was being read.")
+        with open(pdf_path, "wb") as f:
+            stream.readinto(f)
+        return pdf_path
+
+    def read_cache(file_name):
+        sidecar_client = container_client.get_blob_client(
+            pdf_text_sidecar_name(file_name)
+        )
+        try:
+            sidecar_etag = sidecar_client.get_blob_properties().metadata.get(
+                "source_etag"
+            )
+        except ResourceNotFoundError:
+            return None
+        etag = container_client.get_blob_client(file_name).get_blob_properties().etag
+        if sidecar_etag != etag.strip('"'):
+            return None
+        cached_etags[file_name] = sidecar_etag
+        return pdf_text_from_frame(
+            pd.read_parquet(
+                BytesIO(sidecar_client.download_blob().readall()), engine="pyarrow"
+            )
+        )
+
+    def write_cache(file_name, page_text, num_pages):
+        upload_parquet(
+            pdf_text_to_frame(page_text, num_pages),
+            account_url,
+            container_name,
+            pdf_text_sidecar_name(file_name),
+            metadata={"source_etag": etags[file_name]},
+        )
+
+    with TemporaryDirectory() as tmp_dir:
+        return extract_pdf_text_batch(
+            file_names,
+            fetch_pdf,
+            pages=pages,
+            max_workers=max_workers,
+            pages_per_chunk=pages_per_chunk,
+            read_cache=read_cache if cache_text else None,
+            write_cache=write_cache if cache_text else None,
+            release_pdf=lambda file_name, pdf_path: os.remove(pdf_path),
+            max_io_workers=max_download_workers,
+        )
+
+
 def update_blob_metadata(account_url, container_name, blob_name, metadata_dict):
     """
     Update blob metadata for an exsting blob. Note that
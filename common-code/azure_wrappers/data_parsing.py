@@ -1,5 +1,17 @@
 import io
+import multiprocessing
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    BrokenExecutor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import nullcontext
 from logging import Logger
+from tempfile import TemporaryDirectory
 
 try:
     import geopandas as gpd
@@ -11,6 +23,8 @@ except ImportError:
 import numpy as np
 import pandas as pd
 import PyPDF2
+from openpyxl.utils import column_index_from_string
+from pandas.errors import ParserError
 
 try:
     import cv2
@@ -20,13 +34,24 @@ except ImportError:
     HAVE_CV = False
 
 LOGGER = Logger(__file__)
+PDF_TEXT_SIDECAR_SUFFIX = "_text.parquet"
+EXCEL_SIDECAR_SUFFIX = "_sheets"
+EXCEL_SIDECAR_MANIFEST = "manifest.json"
 
 
 def parse_data_source(
     file_name,
     stream,
     return_stream=None,
+    sheet_name=None,
+    usecols=None,
+    nrows=None,
 ):
+    """
+    Parse a downloaded blob based on its file extension. sheet_name, usecols
+    and nrows are passed to pd.read_excel for .xls* files so only the needed
+    sheets, columns and rows get parsed.
+    """
     if return_stream:
         data = stream
     elif ".csv" in file_name:
@@ -42,11 +67,18 @@ def parse_data_source(
     elif ".dta" in file_name:
         data = pd.read_stata(io.StringIO(stream.readall().decode("utf-8")))
     elif ".xls" in file_name:
-        data = pd.read_excel(stream.stream, sheet_name=None, engine="openpyxl")
-        LOGGER.info(
-            "Excel files are downloaded as dictionaries where each "
-            "sheet is a key:value pair."
+        data = pd.read_excel(
+            stream.stream,
+            sheet_name=sheet_name,
+            usecols=usecols,
+            nrows=nrows,
+            engine="openpyxl",
         )
+        if sheet_name is None:
+            LOGGER.info(
+                "Excel files are downloaded as dictionaries where each "
+                "sheet is a key:value pair."
+            )
     elif ".parquet" in file_name:
         data = pd.read_parquet(io.BytesIO(stream.readall()), engine="pyarrow")
     elif ".txt" in file_name:
@@ -89,3 +121,425 @@ def parse_data_source(
     if isinstance(data, pd.DataFrame):
         LOGGER.info(f"{file_name} parsed as a dataframe has {len(data)} entries.")
     return data
+
+
+def pdf_text_sidecar_name(file_name):
+    """
+    Name of the parquet file that caches the extracted text of a pdf,
+    e.g. reports/case_1.pdf -> reports/case_1_text.parquet
+    """
+    return os.path.splitext(file_name)[0] + PDF_TEXT_SIDECAR_SUFFIX
+
+
+def pdf_text_to_frame(page_text, num_pages):
+    """
+    Convert a {page_number: text} dictionary to a dataframe with page, text
+    and num_pages columns so it can be cached as parquet. The cache may hold
+    only some pages, so the page count of the pdf is kept alongside them.
+    """
+    return pd.DataFrame(
+        {
+            "page": list(page_text.keys()),
+            "text": list(page_text.values()),
+            "num_pages": num_pages,
+        }
+    )
+
+
+def pdf_text_from_frame(data):
+    """
+    Inverse of pdf_text_to_frame, returns ({page_number: text}, num_pages).
+    """
+    if data.empty:
+        return {}, 0
+    return dict(zip(data["page"].astype(int), data["text"])), int(
+        data["num_pages"].iloc[0]
+    )
+
+
+def _validate_pages(pages, num_pages, file_name):
+    if pages is None:
+        return list(range(num_pages))
+    pages = sorted(set(pages))
+    out_of_range = [page for page in pages if page < 0 or page >= num_pages]
+    if out_of_range:
+        raise ValueError(
+            f"Pages {out_of_range} are out of range for {file_name} which has "
+            f"{num_pages} pages."
+        )
+    return pages
+
+
+def _clip_pages(pages, num_pages):
+    # in a batch the documents have different lengths, so pages past the end
+    # of a document are skipped rather than treated as an error
+    if pages is None:
+        return list(range(num_pages))
+    return sorted(page for page in set(pages) if 0 <= page < num_pages)
+
+
+def _extract_page_chunk(pdf_path, page_numbers):
+    # runs in a worker process, so it gets a path rather than the pdf bytes
+    reader = PyPDF2.PdfReader(pdf_path)
+    return {page: reader.pages[page].extract_text() for page in page_numbers}
+
+
+def _submit(executor, fn, *args):
+    # run inline when there is no pool so callers can treat both the same way
+    if executor is None:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return executor.submit(fn, *args)
+
+
+def extract_pdf_text_batch(
+    file_names,
+    fetch_pdf,
+    pages=None,
+    max_workers=None,
+    pages_per_chunk=8,
+    read_cache=None,
+    write_cache=None,
+    release_pdf=None,
+    max_io_workers=8,
+    max_pending=None,
+    raise_errors=False,
+):
+    """
+    Extract the text of a batch of pdfs. Returns a dictionary of
+    {file_name: {page_number: text}} where page numbers are zero-indexed,
+    matching PdfReader.pages. Pages past the end of a shorter document are
+    skipped. A document that cannot be read is logged and left out of the
+    result unless raise_errors is True.
+
+    fetch_pdf(file_name) returns a local path to the pdf and
+    release_pdf(file_name, pdf_path) is called once its text has been
+    extracted. read_cache(file_name) returns ({page_number: text}, num_pages)
+    or None, and write_cache(file_name, page_text, num_pages) stores the
+    cached pages together with any newly extracted ones, so only pages that
+    are not cached yet get extracted.
+
+    Fetching and cache reads run in a thread pool of max_io_workers so
+    downloads overlap, and at most max_pending documents (twice
+    max_io_workers by default) are fetched ahead of extraction. Every
+    document is split into chunks of pages_per_chunk pages that share one
+    process pool of max_workers. The workers are spawned rather than forked,
+    so scripts calling this need the usual if __name__ == "__main__" guard.
+    With max_workers=1 everything runs in this process.
+    """
+    file_names = list(dict.fromkeys(file_names))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * max_io_workers
+
+    def load(file_name):
+        cached = None
+        if read_cache is not None:
+            try:
+                cached = read_cache(file_name)
+            except Exception as e:
+                LOGGER.warning(f"Ignoring the cached text of {file_name}: {e}")
+        if cached is not None:
+            page_text, num_pages = cached
+            if all(page in page_text for page in _clip_pages(pages, num_pages)):
+                return None, cached
+        return fetch_pdf(file_name), cached
+
+    results = {}
+    documents = {}
+    futures = {}
+    waiting = iter(file_names)
+    active = set()
+
+    def release(file_name):
+        active.discard(file_name)
+        document = documents.pop(file_name, None)
+        if release_pdf is not None and document and document["pdf_path"]:
+            release_pdf(file_name, document["pdf_path"])
+
+    def fail(file_name, error):
+        if raise_errors:
+            raise error
+        LOGGER.warning(f"Could not extract text from {file_name}: {error}")
+        release(file_name)
+
+    def finish(file_name):
+        document = documents[file_name]
+        page_text = document["text"]
+        results[file_name] = {page: page_text[page] for page in document["wanted"]}
+        if write_cache is not None and document["new_pages"]:
+            future = io_executor.submit(
+                write_cache, file_name, page_text, document["num_pages"]
+            )
+            futures[future] = ("write", file_name)
+        LOGGER.info(f"Extracted text from {len(results[file_name])} pages of {file_name}")
+        release(file_name)
+
+    def start(file_name, loaded):
+        pdf_path, cached = loaded
+        if pdf_path is None:
+            page_text, num_pages = cached
+            results[file_name] = {
+                page: page_text[page] for page in _clip_pages(pages, num_pages)
+            }
+            active.discard(file_name)
+            return
+        documents[file_name] = {"pdf_path": pdf_path}
+        num_pages = len(PyPDF2.PdfReader(pdf_path).pages)
+        page_text = {}
+        if cached is not None and cached[1] == num_pages:
+            page_text = dict(cached[0])
+        wanted = _clip_pages(pages, num_pages)
+        to_extract = [page for page in wanted if page not in page_text]
+        chunks = [
+            to_extract[i : i + pages_per_chunk]
+            for i in range(0, len(to_extract), pages_per_chunk)
+        ]
+        documents[file_name].update(
+            num_pages=num_pages,
+            wanted=wanted,
+            text=page_text,
+            new_pages=bool(to_extract),
+            remaining=len(chunks),
+        )
+        if not chunks:
+            finish(file_name)
+        for chunk in chunks:
+            future = _submit(executor, _extract_page_chunk, pdf_path, chunk)
+            futures[future] = ("chunk", file_name)
+
+    def fill():
+        while len(active) < max_pending:
+            file_name = next(waiting, None)
+            if file_name is None:
+                return
+            active.add(file_name)
+            futures[io_executor.submit(load, file_name)] = ("load", file_name)
+
+    # spawn rather than fork, the download threads may hold locks when the
+    # workers start
+    process_pool = (
+        ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        if max_workers > 1
+        else nullcontext()
+    )
+    with ThreadPoolExecutor(max_workers=max_io_workers) as io_executor, (
+        process_pool
+    ) as executor:
+        fill()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, file_name = futures.pop(future)
+                if kind == "write":
+                    try:
+                        future.result()
+                    except Exception as e:
+                        LOGGER.warning(f"Could not cache the text of {file_name}: {e}")
+                    continue
+                if kind == "chunk" and file_name not in documents:
+                    # another chunk of this document already failed
+                    continue
+                try:
+                    if kind == "load":
+                        start(file_name, future.result())
+                    else:
+                        documents[file_name]["text"].update(future.result())
+                        documents[file_name]["remaining"] -= 1
+                        if not documents[file_name]["remaining"]:
+                            finish(file_name)
+                except BrokenExecutor:
+                    # not a problem with this document, the pool is unusable
+                    raise
+                except Exception as e:
+                    fail(file_name, e)
+            fill()
+
+    return {
+        file_name: results[file_name] for file_name in file_names if file_name in results
+    }
+
+
+def extract_pdf_text(pdf_bytes, pages=None, max_workers=None, pages_per_chunk=8):
+    """
+    Extract the text of a single pdf and return it as a {page_number: text}
+    dictionary. Only the requested pages are parsed, so pages can be a range
+    or list of page numbers to pull text from part of a long document; pages
+    outside the document raise a ValueError. See extract_pdf_text_batch for
+    how the work is split.
+    """
+    num_pages = len(PyPDF2.PdfReader(io.BytesIO(pdf_bytes)).pages)
+    num_chunks = -(-len(_validate_pages(pages, num_pages, "the pdf")) // pages_per_chunk)
+    # no point starting more workers than there are chunks of pages
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, num_chunks))
+    with TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "document.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_bytes)
+        return extract_pdf_text_batch(
+            [pdf_path],
+            lambda file_name: file_name,
+            pages=pages,
+            max_workers=max_workers,
+            pages_per_chunk=pages_per_chunk,
+            raise_errors=True,
+        )[pdf_path]
+
+
+def extract_pdf_text_from_folder(
+    folder_path, pages=None, max_workers=None, pages_per_chunk=8, cache_text=False
+):
+    """
+    Extract text from every pdf in a local folder. Returns a dictionary of
+    {file_name: {page_number: text}}; pdfs that cannot be read are logged
+    and left out.
+
+    If cache_text is True the extracted pages of each pdf are written to a
+    parquet file next to it (see pdf_text_sidecar_name). Later calls read
+    cached pages from there and only extract and add the pages that are not
+    cached yet. The cache is ignored once the pdf is modified.
+    """
+    file_names = sorted(
+        name for name in os.listdir(folder_path) if name.lower().endswith(".pdf")
+    )
+
+    def read_cache(file_name):
+        pdf_path = os.path.join(folder_path, file_name)
+        sidecar_path = pdf_text_sidecar_name(pdf_path)
+        if not os.path.exists(sidecar_path):
+            return None
+        if os.path.getmtime(sidecar_path) < os.path.getmtime(pdf_path):
+            return None
+        return pdf_text_from_frame(pd.read_parquet(sidecar_path, engine="pyarrow"))
+
+    def write_cache(file_name, page_text, num_pages):
+        sidecar_path = pdf_text_sidecar_name(os.path.join(folder_path, file_name))
+        pdf_text_to_frame(page_text, num_pages).to_parquet(
+            sidecar_path, engine="pyarrow", index=False
+        )
+
+    return extract_pdf_text_batch(
+        file_names,
+        lambda file_name: os.path.join(folder_path, file_name),
+        pages=pages,
+        max_workers=max_workers,
+        pages_per_chunk=pages_per_chunk,
+        read_cache=read_cache if cache_text else None,
+        write_cache=write_cache if cache_text else None,
+    )
+
+
+def excel_sidecar_folder(file_name):
+    """
+    Folder that holds the parquet copies of every version of an excel blob.
+    The extension is kept so report.xls and report.xlsx do not share a
+    folder, e.g. data/cms_export.xlsx -> data/cms_export_xlsx_sheets/
+    """
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}_{extension.lstrip('.')}{EXCEL_SIDECAR_SUFFIX}/"
+
+
+def excel_sidecar_prefix(file_name, etag):
+    """
+    Folder that holds the parquet copies of each sheet of an excel blob,
+    keyed by the blob's ETag so a new upload of the workbook is converted
+    again, e.g. data/cms_export.xlsx -> data/cms_export_xlsx_sheets/<etag>/
+    """
+    etag = etag.strip('"')
+    return f"{excel_sidecar_folder(file_name)}{etag}/"
+
+
+def excel_sheet_to_parquet(sheet):
+    """
+    Convert a parsed sheet to parquet bytes. Parquet only allows string
+    column names, so the columns are written as strings and the original
+    names are returned alongside the bytes to be restored on read. Returns
+    None if the sheet would not come back identical, e.g. a header cell that
+    is a date or a column mixing numbers and text.
+    """
+    columns = [col.item() if isinstance(col, np.generic) else col for col in sheet]
+    if not all(
+        isinstance(col, (str, int, float)) and not isinstance(col, bool)
+        for col in columns
+    ):
+        return None
+    if len({str(col) for col in columns}) != len(columns):
+        return None
+    buffer = io.BytesIO()
+    try:
+        sheet.set_axis([str(col) for col in columns], axis=1).to_parquet(
+            buffer, engine="pyarrow"
+        )
+        round_trip = pd.read_parquet(io.BytesIO(buffer.getvalue()), engine="pyarrow")
+    except (TypeError, ValueError) as e:
+        LOGGER.info(f"Could not convert sheet to parquet: {e}")
+        return None
+    if not round_trip.set_axis(columns, axis=1).equals(sheet):
+        return None
+    return buffer.getvalue(), columns
+
+
+def _excel_letters_to_positions(usecols):
+    # e.g. "A:C,E" -> [0, 1, 2, 4], the same format pd.read_excel accepts
+    positions = []
+    for part in usecols.replace(" ", "").split(","):
+        if ":" in part:
+            start, end = part.split(":")
+            positions.extend(
+                range(
+                    column_index_from_string(start) - 1, column_index_from_string(end)
+                )
+            )
+        else:
+            positions.append(column_index_from_string(part) - 1)
+    return positions
+
+
+def select_excel_columns(data, usecols=None, nrows=None):
+    """
+    Apply pd.read_excel style usecols and nrows to an already parsed sheet.
+    Used when a sheet is read back from its parquet copy. Columns stay in
+    workbook order and invalid usecols raise the same errors as
+    pd.read_excel.
+    """
+    if usecols is not None:
+        if isinstance(usecols, str):
+            usecols = _excel_letters_to_positions(usecols)
+        if callable(usecols):
+            data = data[[col for col in data.columns if usecols(col)]]
+        elif all(isinstance(col, int) for col in usecols):
+            out_of_bounds = sorted(
+                {col for col in usecols if col >= len(data.columns)}
+            )
+            if out_of_bounds:
+                raise ParserError(
+                    "Defining usecols with out-of-bounds indices is not allowed. "
+                    f"{out_of_bounds} are out-of-bounds."
+                )
+            # read_excel ignores negative positions and repeats
+            data = data.iloc[:, sorted({col for col in usecols if col >= 0})]
+        elif all(isinstance(col, str) for col in usecols):
+            missing = [col for col in usecols if col not in data.columns]
+            if missing:
+                raise ValueError(
+                    "Usecols do not match columns, columns expected but not "
+                    f"found: {missing}"
+                )
+            data = data[[col for col in data.columns if col in usecols]]
+        else:
+            raise ValueError(
+                "'usecols' must either be list-like of all strings, all unicode, "
+                "all integers or a callable."
+            )
+        # re-infer the index dtype as read_excel would for only these columns
+        data = data.set_axis(pd.Index(list(data.columns)), axis=1)
+    if nrows is not None:
+        data = data.head(nrows)
+    return data
@@ -1,3 +1,7 @@
+import os
+import shutil
+from io import BytesIO
+
 try:
     import cv2
 
@@ -11,6 +15,17 @@ import pytest
 from azure.core.exceptions import ResourceNotFoundError
 
 from ..azure_container import *
+from ..data_parsing import (
+    excel_sheet_to_parquet,
+    excel_sidecar_folder,
+    extract_pdf_text,
+    extract_pdf_text_from_folder,
+    pdf_text_from_frame,
+    pdf_text_to_frame,
+    select_excel_columns,
+)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 DEFAULT_ACCOUNT_URL = "YOUR_ACCOUNT_URL"
 TEST_ACCOUNT_URL = os.environ.get("ACCOUNT_URL", DEFAULT_ACCOUNT_URL)
@@ -91,3 +106,213 @@ def test_download_stream():
     get_az_data(
         TEST_ACCOUNT_URL, TEST_CONTAINER, "test_uploads/sample.pdf", return_stream=True
     )
+
+
+def test_get_az_pdf_text():
+    upload_file_from_path(
+        TEST_ACCOUNT_URL,
+        TEST_CONTAINER,
+        DATA_DIR,
+        "sample.pdf",
+        dest_folder_name="test_pdf_text",
+    )
+    with open(os.path.join(DATA_DIR, "sample.pdf"), "rb") as f:
+        expected = extract_pdf_text(f.read(), max_workers=1)
+    # uncached, converting and cache-hit calls should all agree
+    for cache_text in (False, True, True):
+        text = get_az_pdf_text(
+            TEST_ACCOUNT_URL,
+            TEST_CONTAINER,
+            name_starts_with="test_pdf_text/",
+            cache_text=cache_text,
+        )
+        assert text == {"test_pdf_text/sample.pdf": expected}
+        # pages past the end of a shorter pdf are skipped in a batch
+        assert get_az_pdf_text(
+            TEST_ACCOUNT_URL,
+            TEST_CONTAINER,
+            file_names=["test_pdf_text/sample.pdf"],
+            pages=[1, 99],
+            cache_text=cache_text,
+        ) == {"test_pdf_text/sample.pdf": {1: expected[1]}}
+
+
+def test_extract_pdf_text_pages():
+    with open(os.path.join(DATA_DIR, "sample.pdf"), "rb") as f:
+        pdf_bytes = f.read()
+    all_pages = extract_pdf_text(pdf_bytes, max_workers=1)
+    second_page = extract_pdf_text(pdf_bytes, pages=[1], max_workers=1)
+    assert list(all_pages) == [0, 1]
+    assert second_page == {1: all_pages[1]}
+
+
+def test_extract_pdf_text_process_pool():
+    with open(os.path.join(DATA_DIR, "sample.pdf"), "rb") as f:
+        pdf_bytes = f.read()
+    serial = extract_pdf_text(pdf_bytes, max_workers=1)
+    pooled = extract_pdf_text(pdf_bytes, max_workers=2, pages_per_chunk=1)
+    assert pooled == serial
+
+
+def test_extract_pdf_text_out_of_range():
+    with open(os.path.join(DATA_DIR, "sample.pdf"), "rb") as f:
+        pdf_bytes = f.read()
+    with pytest.raises(ValueError):
+        extract_pdf_text(pdf_bytes, pages=[0, 2])
+
+
+def test_extract_pdf_text_from_folder(tmp_path):
+    for name in ("a.pdf", "b.pdf"):
+        shutil.copy(os.path.join(DATA_DIR, "sample.pdf"), tmp_path / name)
+    (tmp_path / "broken.pdf").write_bytes(b"not a pdf")
+    expected = extract_pdf_text_from_folder(tmp_path, max_workers=1)
+    # the unreadable pdf is left out rather than failing the whole batch
+    assert list(expected) == ["a.pdf", "b.pdf"]
+    assert extract_pdf_text_from_folder(
+        tmp_path, max_workers=2, pages_per_chunk=1
+    ) == expected
+    assert extract_pdf_text_from_folder(tmp_path, pages=[1, 5], max_workers=1) == {
+        name: {1: text[1]} for name, text in expected.items()
+    }
+
+
+def test_extract_pdf_text_from_folder_cache(tmp_path):
+    for name in ("a.pdf", "b.pdf"):
+        shutil.copy(os.path.join(DATA_DIR, "sample.pdf"), tmp_path / name)
+    expected = extract_pdf_text_from_folder(tmp_path, max_workers=1)
+    sidecar_path = tmp_path / "a_text.parquet"
+
+    # only the requested pages are extracted and cached
+    assert extract_pdf_text_from_folder(
+        tmp_path, pages=[1], max_workers=1, cache_text=True
+    ) == {name: {1: text[1]} for name, text in expected.items()}
+    assert pdf_text_from_frame(pd.read_parquet(sidecar_path)) == (
+        {1: expected["a.pdf"][1]},
+        2,
+    )
+    # later calls add the missing pages to the cache
+    cached = extract_pdf_text_from_folder(
+        tmp_path, max_workers=2, pages_per_chunk=1, cache_text=True
+    )
+    assert cached == expected
+    assert pdf_text_from_frame(pd.read_parquet(sidecar_path)) == (
+        expected["a.pdf"],
+        2,
+    )
+
+    # a newer sidecar is trusted, a newer pdf is extracted again
+    pdf_text_to_frame({0: "stale", 1: "stale"}, 2).to_parquet(
+        sidecar_path, index=False
+    )
+    assert extract_pdf_text_from_folder(tmp_path, max_workers=1, cache_text=True)[
+        "a.pdf"
+    ] == {0: "stale", 1: "stale"}
+    sidecar_mtime = os.path.getmtime(sidecar_path)
+    os.utime(tmp_path / "a.pdf", (sidecar_mtime + 10, sidecar_mtime + 10))
+    assert (
+        extract_pdf_text_from_folder(tmp_path, max_workers=1, cache_text=True)
+        == expected
+    )
+
+
+def test_get_excel_sheet():
+    first_sheet = get_az_data(
+        TEST_ACCOUNT_URL,
+        TEST_CONTAINER,
+        "test_uploads/multisheet_test.xlsx",
+        sheet_name=0,
+        nrows=2,
+    )
+    assert isinstance(first_sheet, pd.DataFrame)
+    assert len(first_sheet) == 2
+    some_columns = get_az_data(
+        TEST_ACCOUNT_URL,
+        TEST_CONTAINER,
+        "test_uploads/multisheet_test.xlsx",
+        sheet_name="Sheet1",
+        usecols=["Id", "First Name"],
+    )
+    assert list(some_columns.columns) == ["First Name", "Id"]
+
+
+def test_get_excel_cached():
+    file_name = "test_uploads/multisheet_test.xlsx"
+    container_client = get_container_client(TEST_ACCOUNT_URL, TEST_CONTAINER)
+    for blob in container_client.list_blobs(
+        name_starts_with=excel_sidecar_folder(file_name)
+    ):
+        container_client.delete_blob(blob.name)
+    reads = [
+        {},
+        {"sheet_name": "Sheet1", "usecols": ["Id", "First Name"]},
+        {"sheet_name": 1, "usecols": "B:C"},
+    ]
+    uncached = [
+        get_az_data(TEST_ACCOUNT_URL, TEST_CONTAINER, file_name, **kwargs)
+        for kwargs in reads
+    ]
+    # first pass converts the workbook, second reads the parquet copies
+    for _ in range(2):
+        for kwargs, expected in zip(reads, uncached):
+            cached = get_az_data(
+                TEST_ACCOUNT_URL, TEST_CONTAINER, file_name, cache_excel=True, **kwargs
+            )
+            if isinstance(expected, dict):
+                assert list(cached) == list(expected)
+                for name in expected:
+                    pd.testing.assert_frame_equal(cached[name], expected[name])
+            else:
+                pd.testing.assert_frame_equal(cached, expected)
+
+
+@pytest.mark.parametrize(
+    "usecols, nrows",
+    [
+        (None, None),
+        (["Id", "First Name"], None),
+        ("B:C,F", None),
+        ("A,A", None),
+        ([0, 0, 3], None),
+        ([5, 1, -1], None),
+        (lambda col: col in ("Age", "Country"), None),
+        (None, 3),
+        (["Age"], 1),
+    ],
+)
+def test_select_excel_columns(usecols, nrows):
+    excel_path = os.path.join(DATA_DIR, "multisheet_test.xlsx")
+    for sheet_name, sheet in pd.read_excel(excel_path, sheet_name=None).items():
+        expected = pd.read_excel(
+            excel_path, sheet_name=sheet_name, usecols=usecols, nrows=nrows
+        )
+        pd.testing.assert_frame_equal(
+            select_excel_columns(sheet, usecols, nrows), expected
+        )
+
+
+@pytest.mark.parametrize("usecols", [[0, "Id"], [0, 20], "A:Z", ["Id", "Missing"]])
+def test_select_excel_columns_errors(usecols):
+    excel_path = os.path.join(DATA_DIR, "multisheet_test.xlsx")
+    sheet = pd.read_excel(excel_path, sheet_name=0)
+    with pytest.raises(ValueError):
+        pd.read_excel(excel_path, sheet_name=0, usecols=usecols)
+    with pytest.raises(ValueError):
+        select_excel_columns(sheet, usecols)
+
+
+def test_excel_sheet_to_parquet(tmp_path):
+    excel_path = os.path.join(DATA_DIR, "multisheet_test.xlsx")
+    for sheet in pd.read_excel(excel_path, sheet_name=None).values():
+        # the fixture has an integer 0 header, which parquet stores as "0"
+        assert 0 in sheet.columns
+        parquet_bytes, columns = excel_sheet_to_parquet(sheet)
+        assert columns == list(sheet.columns)
+        round_trip = pd.read_parquet(BytesIO(parquet_bytes)).set_axis(columns, axis=1)
+        pd.testing.assert_frame_equal(round_trip, sheet)
+
+    # sheets that would not round trip are read from the workbook instead
+    mixed_path = tmp_path / "mixed.xlsx"
+    pd.DataFrame({"mixed": [1, "x"], "Id": [1, 2]}).to_excel(mixed_path, index=False)
+    assert excel_sheet_to_parquet(pd.read_excel(mixed_path)) is None
+    assert excel_sheet_to_parquet(pd.DataFrame({pd.Timestamp("2020"): [1]})) is None
+